@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Benchmark and regression suite for pylcdsysinfo, run against a simulated
+# device so that no hardware is needed.
+#
+# Behaviour checks cover text conversion, bitmap conversion, flash writes and
+# verification, reconnecting after a lost device, the frame scheduler and the
+# slideshow streamer. For every benchmarked operation the CPU time, number of
+# USB transfers, bytes sent and received and the time the device would be
+# busy are reported, and optionally stored as JSON. Each operation starts from
+# a fresh device showing the same screen, and the fastest of several repeats
+# is reported as its CPU time. When comparing with stored results from the
+# same number of iterations, any change in transfers, bytes or device time,
+# or CPU time above the tolerance, is a regression. The exit status is
+# non-zero if a check failed or a regression was found.
+
+from __future__ import print_function
+import sys, os, time, json, errno, struct, argparse, platform, traceback
+import usb.core
+from functools import partial
+from pylcdsysinfo import (LCDSysInfo, DeviceConnection, FlashManifest, FrameScheduler,
+    SlideshowStreamer, Priority, TextAlignment, TextColours, BackgroundColours, TextLines,
+    large_image_indexes, CTRL_READ, _page_checksums)
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+class SimulatedContext(object):
+    """Stands in for the pyusb context used to claim and release a device."""
+
+    def managed_claim_interface(self, device, intf):
+        pass
+
+    def dispose(self, device):
+        pass
+
+class SimulatedDevice(object):
+    """Stands in for usb.core.Device, counting transfers and bytes.
+
+    Flash commands are carried out on a simulated flash memory, and
+    failures can be injected into transfers.
+    """
+
+    # Approximate duration of a control transfer on a full speed bus
+    transfer_ms = 1
+
+    def __init__(self):
+        self._ctx = SimulatedContext()
+        self.default_timeout = None
+        self.flash = {}
+        self.failures = []
+        self.power_cycle()
+        self.reset()
+
+    def set_configuration(self):
+        pass
+
+    def power_cycle(self):
+        """Lose the volatile state of the device, as after a USB reset."""
+        self.page_buffer = bytearray(256)
+        self.write_enabled = False
+
+    def reset(self):
+        """Reset the counters and the transfer log."""
+        self.transfers = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.device_ms = 0
+        self.log = []
+
+    def fail(self, bRequest, error, skip=0):
+        """Make a transfer with the specified request fail with a USBError.
+
+        Args:
+            bRequest (int): The request to fail.
+            error (int): The errno of the error. Errors meaning the device was
+                lost also power cycle the device.
+            skip (int): Number of matching transfers to let through first.
+        """
+        self.failures.append([bRequest, error, skip])
+
+    def _inject_failure(self, bRequest):
+        for failure in self.failures:
+            if failure[0] != bRequest:
+                continue
+            if failure[2]:
+                failure[2] -= 1
+                return
+            self.failures.remove(failure)
+            if failure[1] in DeviceConnection.lost_device_errnos:
+                self.power_cycle()
+            raise usb.core.USBError(os.strerror(failure[1]), errno=failure[1])
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        self._inject_failure(bRequest)
+        self.transfers += 1
+        self.device_ms += self.transfer_ms
+        self.log.append((bRequest, wValue, wIndex))
+        if bmRequestType == CTRL_READ:
+            if bRequest == 12 and wIndex == 0:
+                checksum = sum(self.page_buffer)
+                data = bytearray([checksum >> 8, checksum & 0xff])
+            else:
+                # eeprom, serial number and flash id queries
+                data = bytearray(range(1, data_or_wLength + 1))
+            self.bytes_in += len(data)
+            return data
+
+        if data_or_wLength is not None:
+            self.bytes_out += len(data_or_wLength)
+        if bRequest == 16:
+            self.page_buffer[wIndex * 64:(wIndex + 1) * 64] = bytearray(data_or_wLength)
+        elif bRequest == 15:
+            if wIndex == 5:
+                self.write_enabled = True
+            elif wIndex == 1:
+                self.write_enabled = False
+            elif wIndex == 2 and self.write_enabled:
+                for page in range(16):
+                    self.flash[wValue * 16 + page] = b'\xff' * 256
+            elif wIndex == 3 and self.write_enabled:
+                self.flash[wValue] = bytes(self.page_buffer)
+        return len(data_or_wLength or ())
+
+    def read_flash(self, sector, length):
+        """Return the contents of the simulated flash starting at a sector."""
+        pages = (length + 255) // 256
+        return b''.join(self.flash.get(sector * 16 + i, b'\xff' * 256) for i in range(pages))[:length]
+
+class SimulatedConnection(DeviceConnection):
+    """A DeviceConnection which opens a simulated device instead of searching the USB busses."""
+
+    def __init__(self, device, on_reconnect=None):
+        self.simulated_device = device
+        DeviceConnection.__init__(self, 0x16c0, 0x05dc, on_reconnect=on_reconnect)
+
+    def _find_device(self):
+        return self.simulated_device
+
+class SimulatedLCDSysInfo(LCDSysInfo):
+    """Talks to a simulated device through a DeviceConnection, accounting for
+    the waits between commands as device time instead of sleeping.
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        LCDSysInfo.__init__(self, device=SimulatedConnection(sim, on_reconnect=self._replay_state))
+
+    def _wait_ms(self, ms):
+        self.sim.device_ms += ms
+
+def make_bitmap(width, height, seed=0):
+    """Create a 16bpp, RGB 5:6:5 bitmap with a test pattern."""
+    header = bytearray(54)
+    header[0:2] = b'BM'
+    struct.pack_into('<IIIIiiHH', header, 2, 54 + width * height * 2, 0, 54, 40, width, height, 1, 16)
+    pixels = bytearray((i * 7 + seed) & 0xff for i in range(width * height * 2))
+    return bytes(header + pixels)
+
+def draw_screen(d):
+    """Draw the screen each operation starts from, so that the state cache is the same."""
+    d.clear_lines(TextLines.ALL, BackgroundColours.BLACK)
+    d.display_icon(0, large_image_indexes[0])
+    d.display_icon(8, 3)
+    d.display_text_on_line(2, "CPU\t42^C", True, (TextAlignment.LEFT, TextAlignment.RIGHT), TextColours.GREEN)
+    d.display_text_on_line(3, "Reconnected", False, TextAlignment.LEFT, TextColours.WHITE)
+
+def schedule_alert_over_background(d):
+    """Queue a large image background, then an urgent alert, and send both."""
+    scheduler = FrameScheduler(d)
+    scheduler.submit(Priority.LOW, 'display_icon', 0, large_image_indexes[0])
+    scheduler.submit(Priority.URGENT, 'display_text_on_line', 1, "ALERT", False, TextAlignment.CENTRE, TextColours.RED)
+    scheduler.flush()
+    return scheduler
+
+def reconnect_and_replay(d):
+    """Lose the device while redrawing a line which is already on the screen."""
+    d.sim.fail(24, errno.ENODEV)
+    d.display_text_on_line(3, "Reconnected", False, TextAlignment.LEFT, TextColours.WHITE)
+
+def operations():
+    """Return (name, prepare) pairs for all benchmarked operations.
+
+    prepare is called with a SimulatedLCDSysInfo showing draw_screen, and
+    returns the function to be timed.
+    """
+    icon = make_bitmap(36, 36)
+    image = make_bitmap(320, 240)
+    images = {1: icon, large_image_indexes[0]: image}
+
+    def synced(d):
+        manifest = FlashManifest()
+        d.sync_images_to_flash(images, manifest)
+        return manifest
+
+    return [
+        ('set_brightness', lambda d: partial(d.set_brightness, 200)),
+        ('save_brightness', lambda d: partial(d.save_brightness, 127, 255)),
+        ('dim_when_idle', lambda d: partial(d.dim_when_idle, False)),
+        ('set_text_background_colour', lambda d: partial(d.set_text_background_colour, BackgroundColours.BLACK)),
+        ('display_icon', lambda d: partial(d.display_icon, 9, 3)),
+        ('display_icon (large image)', lambda d: partial(d.display_icon, 0, large_image_indexes[0])),
+        ('display_icon_anywhere', lambda d: partial(d.display_icon_anywhere, 100, 100, 3)),
+        ('display_text_on_line', lambda d: partial(d.display_text_on_line, 1, "Lorem ipsum dolor sit amet", False,
+            TextAlignment.LEFT, TextColours.WHITE)),
+        ('display_text_on_line (two columns)', lambda d: partial(d.display_text_on_line, 2, "CPU\t42^C", True,
+            (TextAlignment.LEFT, TextAlignment.RIGHT), TextColours.GREEN)),
+        ('display_text_anywhere', lambda d: partial(d.display_text_anywhere, 10, 10, "Lorem ipsum", TextColours.WHITE)),
+        ('clear_lines', lambda d: partial(d.clear_lines, TextLines.LINE_1, BackgroundColours.BLACK)),
+        ('clear_lines (all)', lambda d: partial(d.clear_lines, TextLines.ALL, BackgroundColours.BLACK)),
+        ('display_cpu_info', lambda d: partial(d.display_cpu_info, 994, 32)),
+        ('display_ram_gpu_info', lambda d: partial(d.display_ram_gpu_info, 1994, 32)),
+        ('display_network_info', lambda d: partial(d.display_network_info, 12, 34)),
+        ('display_fan_info', lambda d: partial(d.display_fan_info, 1994, 1994)),
+        ('send_command_to_flash', lambda d: partial(d.send_command_to_flash, 0, 1)),
+        ('get_device_info', lambda d: d.get_device_info),
+        ('get_serial', lambda d: d.get_serial),
+        ('estimate_wait_ms', lambda d: partial(d.estimate_wait_ms, 'clear_lines', TextLines.ALL, BackgroundColours.BLACK)),
+        ('command_lines', lambda d: partial(d.command_lines, 'display_icon_anywhere', 100, 100, 3)),
+        ('_text_conversion', lambda d: partial(d._text_conversion, "Lorem ipsum dolor sit amet", 8, TextAlignment.CENTRE)),
+        ('_bmp_to_raw (icon)', lambda d: partial(d._bmp_to_raw, icon)),
+        ('_bmp_to_raw (large image)', lambda d: partial(d._bmp_to_raw, image)),
+        ('reconnect and replay', lambda d: partial(reconnect_and_replay, d)),
+        ('FrameScheduler (alert over background)', lambda d: partial(schedule_alert_over_background, d)),
+        ('write_image_to_flash (icon)', lambda d: partial(d.write_image_to_flash, 1, icon)),
+        ('write_image_to_flash (large image)', lambda d: partial(d.write_image_to_flash, large_image_indexes[0], image)),
+        ('verify_flash', lambda d: partial(d.verify_flash, images, synced(d))),
+        ('sync_images_to_flash (up to date)', lambda d: partial(d.sync_images_to_flash, images, synced(d))),
+        ('sync_images_to_flash (all stale)', lambda d: lambda: d.sync_images_to_flash(images, FlashManifest())),
+    ]
+
+def run(iterations, repeats, only=None):
+    """Run the benchmarks and return the per-operation results.
+
+    Each operation is run iterations times on a fresh device, repeats
+    times over, and the fastest mean CPU time of a repeat is reported, as
+    it is the least disturbed by other processes.
+    """
+    results = {}
+    for name, prepare in operations():
+        if only and not any(o in name for o in only):
+            continue
+        # Flash uploads take long enough that a single run is representative
+        count = name.startswith(('write_image', 'sync_images')) and 1 or iterations
+        cpu_ms = []
+        for r in range(repeats):
+            dev = SimulatedDevice()
+            d = SimulatedLCDSysInfo(dev)
+            draw_screen(d)
+            func = prepare(d)
+            dev.reset()
+            start = process_time()
+            for i in range(count):
+                func()
+            cpu_ms.append((process_time() - start) * 1000 / count)
+        results[name] = {
+            'iterations': count,
+            'repeats': repeats,
+            'cpu_ms': min(cpu_ms),
+            'transfers': dev.transfers / float(count),
+            'bytes_out': dev.bytes_out / float(count),
+            'bytes_in': dev.bytes_in / float(count),
+            'device_ms': dev.device_ms / float(count),
+        }
+    return results
+
+def expect(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+def check_text_conversion():
+    d = SimulatedLCDSysInfo(SimulatedDevice())
+    for args, expected in [
+        (("Hi", 8, TextAlignment.LEFT), 'Hi                 {{{{{{{{{'),
+        (("Hi there", 8, TextAlignment.CENTRE), '       Hi___there      '),
+        (("42^C", 3, TextAlignment.RIGHT), '   {{{{{42^C'),
+        (("x" * 60, 2, TextAlignment.NONE), 'xxxx'),
+    ]:
+        result = d._text_conversion(*args)
+        expect(result == expected, "_text_conversion%r returned %r, not %r" % (args, result, expected))
+
+def check_bmp_to_raw():
+    d = SimulatedLCDSysInfo(SimulatedDevice())
+    bitmap = bytearray(make_bitmap(36, 36))
+    raw = d._bmp_to_raw(bytes(bitmap))
+    expect(len(raw) == 36 * 36 * 2 + 8, "raw image is %d bytes" % len(raw))
+    expect(list(raw[0:8]) == [16, 16, 0, 36, 0, 36, 1, 27], "raw header is %r" % list(raw[0:8]))
+    # Rows are stored bottom-up in the bitmap, pixels big-endian in the raw image
+    last_row = 54 + 36 * 35 * 2
+    expect(raw[8] == bitmap[last_row + 1] and raw[9] == bitmap[last_row], "first pixel was not converted")
+
+def check_flash_write():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    for sector, bitmap in [(1, make_bitmap(36, 36, 3)), (large_image_indexes[1], make_bitmap(320, 240, 5))]:
+        raw = d._bmp_to_raw(bitmap)
+        checksums = d.write_image_to_flash(sector, bitmap)
+        expect(checksums == _page_checksums(raw), "checksums of sector %d differ from the image" % sector)
+        expect(sim.read_flash(sector, len(raw)) == bytes(raw), "flash at sector %d differs from the image" % sector)
+        expect(not sim.write_enabled, "flash left write enabled")
+
+def check_flash_manifest():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    images = {1: make_bitmap(36, 36, 1), 2: make_bitmap(36, 36, 2)}
+    manifest = FlashManifest()
+    expect(d.sync_images_to_flash(images, manifest) == [1, 2], "first sync did not write all images")
+    expect(d.sync_images_to_flash(images, manifest) == [], "second sync rewrote images")
+    images[2] = make_bitmap(36, 36, 9)
+    expect(d.verify_flash(images, manifest) == [2], "changed image not found stale")
+    expect(d.verify_flash(images, FlashManifest('other', manifest.slots)) == [1, 2],
+        "manifest of another device was trusted")
+
+def check_reconnect_replay():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    d.clear_lines(TextLines.ALL, BackgroundColours.BLACK)
+    d.display_text_on_line(1, "Line 1", False, TextAlignment.LEFT, TextColours.WHITE)
+    sim.reset()
+    sim.fail(24, errno.ENODEV)
+    d.display_text_on_line(2, "Line 2", False, TextAlignment.LEFT, TextColours.WHITE)
+    expect(d.dev.reconnects == 1, "%d reconnects instead of 1" % d.dev.reconnects)
+    requests = [(r, i >> 8) for r, v, i in sim.log]
+    expect(requests == [(26, 0), (24, 0), (24, 1)], "replay and retry sent %r" % requests)
+
+def check_no_reconnect_on_timeout():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    d.clear_lines(TextLines.ALL, BackgroundColours.BLACK)
+    sim.reset()
+    sim.fail(24, errno.ETIMEDOUT)
+    try:
+        d.display_text_on_line(1, "Line 1", False, TextAlignment.LEFT, TextColours.WHITE)
+        expect(False, "timeout was not raised")
+    except usb.core.USBError:
+        pass
+    expect(d.dev.reconnects == 0 and not sim.log, "timeout caused a reconnect")
+
+def check_flash_write_not_retried():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    sector = large_image_indexes[2]
+    images = {sector: make_bitmap(320, 240, 1)}
+    manifest = FlashManifest()
+    d.sync_images_to_flash(images, manifest)
+    images[sector] = make_bitmap(320, 240, 2)
+    sim.reset()
+    # Lose the device at the first chunk of page 25
+    sim.fail(16, errno.EIO, skip=25 * 4)
+    try:
+        d.sync_images_to_flash(images, manifest)
+        expect(False, "reconnect during flash write was not raised")
+    except IOError:
+        pass
+    programmed = [v for r, v, i in sim.log if r == 15 and i == 3]
+    expect(len(programmed) == 25, "%d pages programmed instead of 25" % len(programmed))
+    expect(sector not in manifest.slots, "partly written slot kept in manifest")
+    expect(d.sync_images_to_flash(images, manifest) == [sector], "failed slot was not rewritten")
+    raw = d._bmp_to_raw(images[sector])
+    expect(sim.read_flash(sector, len(raw)) == bytes(raw), "flash differs from the image after rewrite")
+
+def check_scheduler_overdraw():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    scheduler = schedule_alert_over_background(d)
+    requests = [r for r, v, i in sim.log]
+    expect(requests == [24, 27, 24], "alert and background sent as %r" % requests)
+    expect(scheduler.resent == 1, "alert resent %d times" % scheduler.resent)
+    expect(scheduler.urgent_latency_ms()['count'] == 1, "alert latency not recorded")
+
+def check_scheduler_budget():
+    d = SimulatedLCDSysInfo(SimulatedDevice())
+    scheduler = FrameScheduler(d, 1000)
+    scheduler.submit(Priority.NORMAL, 'clear_lines', TextLines.ALL, BackgroundColours.BLACK)
+    scheduler.submit(Priority.NORMAL, 'clear_lines', TextLines.ALL, BackgroundColours.BLUE)
+    scheduler.submit(Priority.LOW, 'display_icon', 0, 1, deadline_ms=-1)
+    scheduler.run_frame()
+    expect((scheduler.sent, scheduler.pending(), scheduler.dropped) == (1, 2, 0),
+        "first frame sent %d, left %d" % (scheduler.sent, scheduler.pending()))
+    scheduler.run_frame()
+    expect((scheduler.sent, scheduler.pending(), scheduler.dropped) == (2, 0, 1),
+        "second frame sent %d, dropped %d" % (scheduler.sent, scheduler.dropped))
+
+def check_slideshow():
+    sim = SimulatedDevice()
+    d = SimulatedLCDSysInfo(sim)
+    images = [make_bitmap(320, 240, i) for i in range(10)]
+    raws = [bytes(d._bmp_to_raw(image)) for image in images]
+
+    manifest = FlashManifest('other', {large_image_indexes[0]: {'digest': '', 'pages': []}})
+    slideshow = SlideshowStreamer(d, images, period_s=0, manifest=manifest)
+    expect(not manifest.slots, "manifest of another device was kept")
+    slideshow.upload_budget_ms = 10 ** 6
+    slideshow.idle_sleep_ms = 0
+
+    def step():
+        switches = slideshow.switches
+        slideshow.step()
+        if slideshow.switches != switches:
+            expect(sim.read_flash(slideshow.shown_slot, len(raws[0])) == raws[slideshow.shown_index],
+                "slot %d does not hold image %d" % (slideshow.shown_slot, slideshow.shown_index))
+
+    for i in range(25):
+        step()
+    expect(slideshow.switches >= 10, "only %d images shown" % slideshow.switches)
+
+    # A failing upload must not be recorded or shown
+    sim.fail(12, errno.ETIMEDOUT, skip=10)
+    try:
+        for i in range(5):
+            step()
+        expect(False, "failed upload was not raised")
+    except IOError:
+        pass
+    expect(slideshow.failed_uploads == 1, "%d failed uploads" % slideshow.failed_uploads)
+    for slot, entry in manifest.slots.items():
+        expect(len(entry['pages']) == 16 * 38, "partial upload recorded for slot %d" % slot)
+    for i in range(25):
+        step()
+    expect(slideshow.failed_uploads == 1 and slideshow.uploads > 10, "slideshow did not recover")
+
+checks = [
+    check_text_conversion,
+    check_bmp_to_raw,
+    check_flash_write,
+    check_flash_manifest,
+    check_reconnect_replay,
+    check_no_reconnect_on_timeout,
+    check_flash_write_not_retried,
+    check_scheduler_overdraw,
+    check_scheduler_budget,
+    check_slideshow,
+]
+
+def run_checks():
+    """Run the behaviour checks, returning the number of failures."""
+    failures = 0
+    for check in checks:
+        try:
+            check()
+            print("ok    %s" % check.__name__)
+        except Exception:
+            failures += 1
+            print("FAIL  %s" % check.__name__)
+            traceback.print_exc()
+    return failures
+
+def compare(results, baseline, cpu_tolerance):
+    """Return (name, description) for every regression against the baseline."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        r, b = results[name], baseline[name]
+        for key in ('transfers', 'bytes_out', 'bytes_in', 'device_ms'):
+            if abs(r[key] - b[key]) > 1e-6:
+                regressions.append((name, "%s %+.1f" % (key, r[key] - b[key])))
+        if b['cpu_ms'] and r['cpu_ms'] > b['cpu_ms'] * cpu_tolerance:
+            regressions.append((name, "cpu x%.2f" % (r['cpu_ms'] / b['cpu_ms'])))
+    return regressions
+
+def print_results(results, baseline=None):
+    print("%-40s %10s %9s %10s %9s %11s" % ("operation", "cpu ms", "transfers", "bytes out", "bytes in", "device ms"))
+    for name in sorted(results):
+        r = results[name]
+        line = "%-40s %10.3f %9.1f %10.1f %9.1f %11.1f" % (name, r['cpu_ms'], r['transfers'],
+            r['bytes_out'], r['bytes_in'], r['device_ms'])
+        if baseline and name in baseline and baseline[name]['cpu_ms']:
+            line += "  cpu x%.2f" % (r['cpu_ms'] / baseline[name]['cpu_ms'])
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and check pylcdsysinfo against a simulated device.")
+    parser.add_argument('-n', '--iterations', type=int, default=100,
+        help="number of runs of each operation, except flash uploads (default: 100)")
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+        help="number of times the runs are repeated, reporting the fastest (default: 5)")
+    parser.add_argument('-o', '--output', help="store the results as JSON in this file")
+    parser.add_argument('-c', '--compare', help="compare with results previously stored in this file")
+    parser.add_argument('-t', '--cpu-tolerance', type=float, default=1.5,
+        help="CPU time ratio to the stored results above which a run fails (default: 1.5)")
+    parser.add_argument('-l', '--label', default='', help="label stored with the results, e.g. a version")
+    parser.add_argument('--no-checks', action='store_true', help="skip the behaviour checks")
+    parser.add_argument('only', nargs='*', help="only run operations whose name contains one of these")
+    args = parser.parse_args()
+
+    failures = 0
+    if not args.no_checks:
+        failures += run_checks()
+        print()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run(args.iterations, args.repeats, args.only)
+
+    if baseline is not None:
+        for name in sorted(results):
+            if name in baseline and baseline[name]['iterations'] != results[name]['iterations']:
+                parser.error("%s was run %d times, not %d as in %s; use the same --iterations" %
+                    (name, results[name]['iterations'], baseline[name]['iterations'], args.compare))
+    print_results(results, baseline)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.cpu_tolerance)
+        if regressions:
+            print()
+        for name, description in regressions:
+            print("REGRESSION  %s: %s" % (name, description))
+        failures += len(regressions)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'label': args.label,
+                'python': platform.python_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    return failures and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,7 +19,8 @@
 #
 # See <http://www.gnu.org/licenses/gpl-3.0.txt>
 
-import usb.core, time, struct
+import usb.core, usb.util, time, struct, binascii, hashlib, json, os, errno
+from collections import OrderedDict
 
 _font_length_table = [
     0x11, 0x06, 0x08, 0x15, 0x0E, 0x19, 0x15, 0x03, 0x08, 0x08, 0x0F, 0x0D,
@@ -114,6 +115,264 @@ class TextLines(object):
     LINE_6      = 1 << 5
     ALL         = LINE_1 + LINE_2 + LINE_3 + LINE_4 + LINE_5 + LINE_6
 
+class Priority(object):
+    """Priorities of commands queued on a FrameScheduler"""
+    URGENT      = 0
+    NORMAL      = 1
+    LOW         = 2
+
+class DeviceConnection(object):
+
+    """Holds the USB handle of an LCD Sys Info device and transparently
+    reopens it when a transfer fails because the device was lost, e.g.
+    after a USB reset. Other errors, such as timeouts or a stalled request,
+    are raised as usual.
+    """
+
+    # Bounds the time spent reopening the device. Time taken by on_reconnect,
+    # e.g. redrawing the screen, is not included.
+    reconnect_timeout_ms = 3000
+    reconnect_interval_ms = 100
+
+    # Errors meaning the device or its pipe is gone, rather than the request failed
+    lost_device_errnos = (errno.ENODEV, errno.EIO, errno.ECONNRESET, errno.ESHUTDOWN)
+
+    def __init__(self, idVendor, idProduct, index=0, timeout_ms=5000, on_reconnect=None):
+        """Opens a handle to the index'th device with the specified vendor and product id.
+
+        Args:
+            idVendor (int): USB vendor id of the device.
+            idProduct (int): USB product id of the device.
+            index (int): The index of the device in the list of matching
+                devices, with zero (the default) being the first device.
+            timeout_ms (int): Default timeout for USB transfers.
+            on_reconnect (callable): Called without arguments after the device
+                has been reopened, before the failed transfer is retried, e.g.
+                to restore the screen.
+        Raises:
+            IOError: An error ocurred while opening the device.
+        """
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.index = index
+        self.timeout_ms = timeout_ms
+        self.on_reconnect = on_reconnect
+
+        self.reconnects = 0
+        self.failed_reconnects = 0
+        self.last_reconnect_ms = 0
+        self.max_reconnect_ms = 0
+        self._reconnecting = False
+
+        self.dev = None
+        self.open()
+
+    def _find_device(self):
+        """Locate the index'th device with the configured vendor and product id."""
+        devs = list(usb.core.find(idVendor=self.idVendor, idProduct=self.idProduct, find_all=True))
+        if self.index >= len(devs):
+            return None
+        return devs[self.index]
+
+    def open(self):
+        """Find the device and claim its interface.
+
+        Raises:
+            IOError: An error ocurred while opening the device.
+        """
+        dev = self._find_device()
+        if dev is None:
+            raise IOError("LCD Sys Info device not found")
+
+        interface = 0
+        try:
+            dev.set_configuration()
+            dev._ctx.managed_claim_interface(dev, interface)
+        except usb.core.USBError:
+            try:
+                dev.detach_kernel_driver(interface)
+                dev._ctx.managed_claim_interface(dev, interface)
+            except usb.core.USBError:
+                raise IOError("Failed to claim interface")
+
+        self.dev = dev
+        self.dev.default_timeout = self.timeout_ms
+
+    def close(self):
+        """Release the device handle, ignoring errors from a vanished device."""
+        if self.dev is not None:
+            try:
+                usb.util.dispose_resources(self.dev)
+            except usb.core.USBError:
+                pass
+            self.dev = None
+
+    def reconnect(self):
+        """Reopen the device, retrying until reconnect_timeout_ms has elapsed.
+
+        Raises:
+            IOError: The device could not be reopened in time.
+        """
+        start = time.time()
+        deadline = start + self.reconnect_timeout_ms / 1000.0
+        while True:
+            self.close()
+            try:
+                self.open()
+                if self.on_reconnect is not None:
+                    self._reconnecting = True
+                    try:
+                        self.on_reconnect()
+                    finally:
+                        self._reconnecting = False
+                break
+            except (IOError, usb.core.USBError):
+                if time.time() + self.reconnect_interval_ms / 1000.0 > deadline:
+                    self.close()
+                    self.failed_reconnects += 1
+                    raise IOError("LCD Sys Info device did not come back within %d ms" % self.reconnect_timeout_ms)
+                time.sleep(self.reconnect_interval_ms / 1000.0)
+
+        self.reconnects += 1
+        self.last_reconnect_ms = (time.time() - start) * 1000
+        self.max_reconnect_ms = max(self.max_reconnect_ms, self.last_reconnect_ms)
+
+    def _device_lost(self, error):
+        """Whether a USB error means the device has to be reopened."""
+        return getattr(error, 'errno', None) in self.lost_device_errnos
+
+    def ctrl_transfer(self, *args, **kwargs):
+        """Perform a control transfer, reopening the device once if it was lost.
+
+        Takes the same arguments as usb.core.Device.ctrl_transfer, and:
+
+        Args:
+            retry (bool): Keyword only. If false, the device is reopened but
+                the transfer is not retried and IOError is raised instead,
+                for transfers which are part of a sequence that has to be
+                restarted as a whole. Defaults to true.
+        """
+        retry = kwargs.pop('retry', True)
+        if self.dev is None and not self._reconnecting:
+            self.reconnect()
+        try:
+            return self.dev.ctrl_transfer(*args, **kwargs)
+        except usb.core.USBError as e:
+            # Errors while replaying state are retried by reconnect()
+            if self._reconnecting or not self._device_lost(e):
+                raise
+            self.reconnect()
+            if not retry:
+                raise IOError("LCD Sys Info device was reconnected, transfer not retried")
+            return self.dev.ctrl_transfer(*args, **kwargs)
+
+def _image_sectors(rawfile):
+    """Number of flash sectors erased to write a raw format image."""
+    return 1 + int(len(rawfile) / 4096)
+
+def _page_checksums(rawfile):
+    """Calculate the device's checksum of every 256-byte flash page written
+    for a raw format image, including the zero padding of its last sector.
+    """
+    pages = 16 * _image_sectors(rawfile)
+    return [sum(bytearray(rawfile[i * 256:(i + 1) * 256])) for i in range(pages)]
+
+def _check_overlaps(rawfiles):
+    """Raise ValueError if raw format images would be written over each other.
+
+    Args:
+        rawfiles (dict): Maps starting sectors to raw format images.
+    """
+    end = None
+    for sector in sorted(rawfiles):
+        if end is not None and sector < end:
+            raise ValueError("Image at sector %d overlaps the image before it" % sector)
+        end = sector + _image_sectors(rawfiles[sector])
+
+class FlashManifest(object):
+
+    """A record of the images written to the flash slots of a device.
+
+    The device offers no way of reading flash contents back, so the manifest
+    stores a digest of each image and the page checksums confirmed by the
+    device while writing it. It is stored as JSON and compared against the
+    images which should be present, so that only stale slots need to be
+    rewritten.
+
+    The manifest is therefore only valid while every write to the device goes
+    through it. Writing with write_image_to_flash directly, e.g. with the
+    write-image.py and write-icon.py scripts, invalidates the manifest, which
+    must then be discarded.
+    """
+
+    def __init__(self, serial=None, slots=None):
+        """Create a manifest.
+
+        Args:
+            serial (str): Hex serial number of the device the manifest describes.
+            slots (dict): Maps the starting sector of each written image to a dict
+                with the "digest" of its raw data and the checksums of its "pages".
+        """
+        self.serial = serial
+        self.slots = slots or {}
+
+    @classmethod
+    def load(cls, path):
+        """Load a manifest from a JSON file, or return an empty one if the file does not exist."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data.get('serial'), dict((int(k), v) for k, v in data.get('slots', {}).items()))
+
+    def save(self, path):
+        """Save the manifest to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump({'serial': self.serial, 'slots': dict((str(k), v) for k, v in self.slots.items())},
+                f, indent=2, sort_keys=True)
+
+    def forget(self, sector, sectors):
+        """Forget the slots overlapping a range of sectors, e.g. before it is overwritten.
+
+        Args:
+            sector (int): The first sector of the range.
+            sectors (int): The number of sectors in the range.
+        """
+        for other in list(self.slots):
+            other_sectors = (len(self.slots[other]['pages']) + 15) // 16
+            if other < sector + sectors and sector < other + max(1, other_sectors):
+                del self.slots[other]
+
+    def record(self, sector, rawfile, checksums):
+        """Record that a raw format image has been written at the specified sector.
+
+        Slots whose sectors were overwritten by the image are forgotten.
+
+        Raises:
+            ValueError: The checksums do not cover every page of the image.
+        """
+        if len(checksums) != 16 * _image_sectors(rawfile):
+            raise ValueError("Expected %d page checksums, not %d" % (16 * _image_sectors(rawfile), len(checksums)))
+        self.forget(sector, _image_sectors(rawfile))
+        self.slots[sector] = {'digest': hashlib.sha1(bytes(rawfile)).hexdigest(), 'pages': list(checksums)}
+
+    def stale_slots(self, images):
+        """Return the sorted starting sectors of the images which differ from the manifest.
+
+        An image is up to date if both the digest and the page checksums
+        confirmed by the device while writing match.
+
+        Args:
+            images (dict): Maps starting sectors to raw format images.
+        """
+        stale = []
+        for sector, rawfile in images.items():
+            entry = self.slots.get(sector)
+            if entry is None or entry['digest'] != hashlib.sha1(bytes(rawfile)).hexdigest() \
+                    or entry['pages'] != _page_checksums(rawfile):
+                stale.append(sector)
+        return sorted(stale)
+
 class LCDSysInfo(object):
 
     """A Python driver for the Coldtears LCD Sys Info
@@ -132,44 +391,145 @@ class LCDSysInfo(object):
     max_display_text_wait_ms = 85
     chars_per_icon = 2.75
 
-    def __init__(self, index=0):
+    # Number of icons and text drawn at exact positions kept for replay
+    max_anywhere_states = 8
+
+    def __init__(self, index=0, device=None):
         """Opens a handle to an LCD Sys Info device.
 
         Args:
             index (int): The index of the device in the list of connected LCD
                 Sys Info devices, with zero (the default) being the first device.
+            device: If provided, an object with a ctrl_transfer method, like
+                usb.core.Device, which is used instead of opening a device,
+                e.g. a simulated device.
         Raises:
             IOError: An error ocurred while opening the LCD Sys Info device.
         """
+        self._state = OrderedDict()
+        if device is not None:
+            self.dev = device
+        else:
+            self.dev = DeviceConnection(0x16c0, 0x05dc, index, self.usb_timeout_ms,
+                on_reconnect=self._replay_state)
 
-        devs = usb.core.find(idVendor=0x16c0, idProduct=0x05dc, find_all=True)
-        if not devs or len(devs) < index:
-            raise IOError("LCD Sys Info device not found")
-        dev = devs[index]
+    def _remember(self, key, lines, opaque, method, *args):
+        """Record a drawing command in the screen state cache.
 
-        interface = 0
-        try:
-            dev.set_configuration()
-            dev._ctx.managed_claim_interface(dev, interface)
-        except usb.core.USBError:
-            try:
-                dev.detach_kernel_driver(interface)
-                dev._ctx.managed_claim_interface(dev, interface)
-            except usb.core.USBError:
-                raise IOError("Failed to claim interface")
+        Args:
+            key (tuple): Identifies what is drawn; a newer command with the
+                same key replaces the older one.
+            lines (int): The lines covered by the command, from
+                pylcdsysinfo.TextLines OR'd together, or 0 for settings
+                which are not affected by drawing.
+            opaque (bool): If true, the command overdraws everything on the
+                covered lines, so older commands confined to them are dropped.
+            method (str): Name of the method to call on replay.
+        """
+        if opaque:
+            for k in [k for k, v in self._state.items() if v[0] and not v[0] & ~lines]:
+                del self._state[k]
+        self._state.pop(key, None)
+        self._state[key] = (lines, method, args)
+
+        # Drawing at exact positions is not replaced by later commands, so only
+        # the most recent is kept to bound the time taken by a replay
+        anywhere = [k for k in self._state if k[0] in ('icon_anywhere', 'text_anywhere')]
+        for k in anywhere[:max(0, len(anywhere) - self.max_anywhere_states)]:
+            del self._state[k]
+
+    def _replay_state(self):
+        """Redraw the screen from the state cache, e.g. after a USB reset."""
+        for lines, method, args in list(self._state.values()):
+            getattr(self, method)(*args)
+
+    def _region_lines(self, pos_y, height):
+        """Lines covered by a region with its top edge at pos_y."""
+        first = max(0, min(pos_y // 40, 5))
+        last = max(0, min((pos_y + height - 1) // 40, 5))
+        return sum(1 << line for line in range(first, last + 1))
+
+    def _icon_lines(self, pos_y, icon_number):
+        """Lines covered by an icon drawn with its top edge at pos_y."""
+        return self._region_lines(pos_y, icon_number in large_image_indexes and 240 or 36)
+
+    def _wait_ms(self, ms):
+        """Give the device time to process a command before sending more data."""
+        time.sleep(ms / 1000.0)
+
+    def _icon_wait_ms(self, icon_number):
+        """Time taken by the device to draw an icon."""
+        if icon_number in large_image_indexes:
+            return self.max_display_icon_wait_ms
+        return self.min_display_icon_wait_ms
 
-        self.dev = dev
-        self.dev.default_timeout = self.usb_timeout_ms
-
-    def _find_device(self, idVendor, idProduct, index):
-        """Locate the index'th device with specified vendor and product id."""
-        for bus in usb.busses():
-            for dev in bus.devices:
-                if dev.idVendor == idVendor and dev.idProduct == idProduct:
-                    index -= 1
-                    if index < 0:
-                        return dev
-        return None
+    def _text_wait_ms(self, text_string, pad_for_icon, field_length):
+        """Time taken by the device to draw a line of text."""
+        if '\t' in text_string:
+            field_length = pad_for_icon and 7 or 8
+        else:
+            field_length = min(field_length, pad_for_icon and 7 or 8)
+        field_length_as_percent = field_length * self.chars_per_icon / 22.0
+        return self.max_display_text_wait_ms * field_length_as_percent
+
+    def _clear_lines_wait_ms(self, lines):
+        """Time taken by the device to clear lines."""
+        lines = max(1, min(lines, 63))
+        return self.clear_line_wait_ms * (count_bits_set(lines) / 6.0) * 0.8
+
+    def estimate_wait_ms(self, method, *args):
+        """Estimate how long the device will be busy with a command.
+
+        Args:
+            method (str): Name of the LCDSysInfo method, e.g. "clear_lines".
+            args: The arguments which would be passed to the method.
+        Returns:
+            The time in milliseconds the method waits for the device, or 0
+            for commands which take effect immediately.
+        """
+        if method == 'display_icon':
+            return self._icon_wait_ms(args[1])
+        elif method == 'display_icon_anywhere':
+            return self._icon_wait_ms(args[2])
+        elif method == 'display_text_on_line':
+            return self._text_wait_ms(args[1], args[2], args[5] if len(args) > 5 else 8)
+        elif method == 'display_text_anywhere':
+            return self.max_display_text_wait_ms
+        elif method == 'clear_lines':
+            return self._clear_lines_wait_ms(args[0])
+        elif method in ('display_cpu_info', 'display_ram_gpu_info', 'display_network_info', 'display_fan_info'):
+            return self.display_sysinfo_wait_ms
+        elif method == 'write_image_to_flash':
+            bitmap = args[1]
+            width = self._le_unpack(bytearray(bitmap[0x12:0x15]))
+            height = self._le_unpack(bytearray(bitmap[0x16:0x19]))
+            sectors = 1 + int((width * height * 2 + 8) / 4096)
+            return sectors * (self.erase_sector_wait_ms + 16 * self.write_page_wait_ms)
+        return 0
+
+    def command_lines(self, method, *args):
+        """Determine which lines of the display a command draws on.
+
+        Args:
+            method (str): Name of the LCDSysInfo method, e.g. "clear_lines".
+            args: The arguments which would be passed to the method.
+        Returns:
+            The lines from pylcdsysinfo.TextLines OR'd together, as recorded
+            in the screen state cache, or 0 for commands which do not draw.
+        """
+        if method == 'display_icon':
+            return self._icon_lines((max(0, min(args[0], 47)) // 8) * 40, args[1])
+        elif method == 'display_icon_anywhere':
+            return self._icon_lines(max(0, min(args[1], 240)), args[2])
+        elif method == 'display_text_on_line':
+            return 1 << (max(1, min(args[0], 6)) - 1)
+        elif method == 'display_text_anywhere':
+            return self._region_lines(max(0, min(args[1], 240)), 40)
+        elif method == 'clear_lines':
+            return max(1, min(args[0], 63))
+        elif method in ('display_cpu_info', 'display_ram_gpu_info', 'display_network_info', 'display_fan_info'):
+            return TextLines.ALL
+        return 0
 
     def _le_unpack(self, byte):
         """Converts little-endian byte string to integer."""
@@ -211,6 +571,7 @@ class LCDSysInfo(object):
         """
         value = max(0, min(value, 255))
         self.dev.ctrl_transfer(CTRL_WRITE, 13, min(value, 255), min(value, 255))
+        self._remember(('brightness',), 0, False, 'set_brightness', value)
 
     def save_brightness(self, off_value, on_value):
         """Set the brightness of the LCD backlight when idle and active and
@@ -238,11 +599,15 @@ class LCDSysInfo(object):
         # TODO create enumeration class for icons
         position = max(0, min(position, 47))
         self.dev.ctrl_transfer(CTRL_WRITE, 27, position * 512 + icon_number, 25600)
-
         if icon_number in large_image_indexes:
-            time.sleep(self.max_display_icon_wait_ms / 1000.0)
+            # Large images fill the screen and replace each other
+            key = ('background',)
         else:
-            time.sleep(self.min_display_icon_wait_ms / 1000.0)
+            key = ('icon', position, 36)
+        self._remember(key, self._icon_lines((position // 8) * 40, icon_number),
+            icon_number in large_image_indexes, 'display_icon', position, icon_number)
+
+        self._wait_ms(self._icon_wait_ms(icon_number))
 
     def display_icon_anywhere(self, pos_x, pos_y, icon_number):
         """Display an icon at an exact position on the device.
@@ -266,11 +631,14 @@ class LCDSysInfo(object):
         ba = struct.pack("<BBBB", pos_y >> 8, pos_y & 0xFF, pos_x >> 8, pos_x & 0xFF)
         tmp = (icon_number << 8) + icon_number
         self.dev.ctrl_transfer(CTRL_WRITE, 29, tmp, tmp, ba)
-
         if icon_number in large_image_indexes:
-            time.sleep(self.max_display_icon_wait_ms / 1000.0)
+            key = ('background',)
         else:
-            time.sleep(self.min_display_icon_wait_ms / 1000.0)
+            key = ('icon_anywhere', pos_x, pos_y, 36)
+        self._remember(key, self._icon_lines(pos_y, icon_number),
+            icon_number in large_image_indexes, 'display_icon_anywhere', pos_x, pos_y, icon_number)
+
+        self._wait_ms(self._icon_wait_ms(icon_number))
 
     def set_text_background_colour(self, colour):
         """Set the background colour for text display.
@@ -279,6 +647,7 @@ class LCDSysInfo(object):
             colour (int): The background colour from pylcdsysinfo.BackgroundColours.
         """
         self.dev.ctrl_transfer(CTRL_WRITE, 30, colour, 0)
+        self._remember(('text_background',), 0, False, 'set_text_background_colour', colour)
 
     def _align_text(self, mm, alignment, screen_px, string_length_px):
         """Align text suitably for the specified screen width"""
@@ -324,15 +693,19 @@ class LCDSysInfo(object):
                 which left/center/right alignment applies to the specified
                 number of icon widths. Ignored if text_string contains "\\t".
         """
+        args = (line, text_string, pad_for_icon, alignment, colour, field_length)
+        full_line = '\t' in text_string or field_length >= (pad_for_icon and 7 or 8)
+        wait_ms = self._text_wait_ms(text_string, pad_for_icon, field_length)
         field_length = min(field_length, pad_for_icon and 7 or 8)
 
         if '\t' in text_string:
             field_length = [pad_for_icon and 3 or 4] * 2
             text_string = [x.replace('\t', '') for x in text_string.split('\t', 1)]
 
-            if isinstance(alignment, tuple):
+            if isinstance(alignment, (list, tuple)):
+                # Copy, as the list is modified below and kept for replay
                 alignment = list(alignment)
-            elif not isinstance(alignment, list):
+            else:
                 alignment = [alignment] * 2
 
             # Make room for the icon
@@ -355,13 +728,16 @@ class LCDSysInfo(object):
             text_string = text_string.encode("ascii")
         self.dev.ctrl_transfer(CTRL_WRITE, 24, text_length, (line - 1) * 256 + colour,
             text_string)
+        if full_line:
+            # Replaces the whole line, including narrower fields drawn on it before
+            for k in [k for k in self._state if k[0] == 'line' and k[1] == line]:
+                del self._state[k]
+            key = ('line', line)
+        else:
+            key = ('line', line, field_length, args[3])
+        self._remember(key, 1 << (line - 1), False, 'display_text_on_line', *args)
 
-
-        # Return how long to wait before sending more data
-        if isinstance(field_length, (list, tuple)):
-            field_length = sum(field_length)
-        field_length_as_percent = field_length * self.chars_per_icon / 22.0
-        time.sleep(self.max_display_text_wait_ms * field_length_as_percent / 1000)
+        self._wait_ms(wait_ms)
 
     def display_text_anywhere(self, pos_x, pos_y, text_string, colour):
         """Display text at an exact position on the device.
@@ -390,8 +766,13 @@ class LCDSysInfo(object):
         text_length = len(text_string)
         colour = min(colour, 32)
         self.dev.ctrl_transfer(CTRL_WRITE, 25, text_length, colour, ba)
+        # The text is drawn up to the right edge, covering text drawn further right before
+        for k in [k for k in self._state if k[0] == 'text_anywhere' and k[2] == pos_y and k[1] >= pos_x]:
+            del self._state[k]
+        self._remember(('text_anywhere', pos_x, pos_y), self._region_lines(pos_y, 40), False,
+            'display_text_anywhere', pos_x, pos_y, text_string, colour)
 
-        time.sleep(self.max_display_text_wait_ms / 1000)
+        self._wait_ms(self.max_display_text_wait_ms)
 
     def dim_when_idle(self, value):
         """Set whether to dim the LCD backlight after the device has been idle for 10 seconds.
@@ -404,6 +785,7 @@ class LCDSysInfo(object):
             self.dev.ctrl_transfer(CTRL_WRITE, 17, 1, 0)
         else:
             self.dev.ctrl_transfer(CTRL_WRITE, 17, 0, 266)
+        self._remember(('dim_when_idle',), 0, False, 'dim_when_idle', value)
 
     def clear_lines(self, lines, colour):
         """Clear lines of the display using a coloured background.
@@ -415,7 +797,8 @@ class LCDSysInfo(object):
         """
         lines = max(1, min(lines, 63))
         self.dev.ctrl_transfer(CTRL_WRITE, 26, lines, colour)
-        time.sleep(self.clear_line_wait_ms * (count_bits_set(lines) / 6.0) * 0.8 / 1000)
+        self._remember(('clear', lines), lines, True, 'clear_lines', lines, colour)
+        self._wait_ms(self._clear_lines_wait_ms(lines))
 
     def display_cpu_info(self, cpu_util, cpu_temp, util_colour=TextColours.GREEN, temp_colour=TextColours.GREEN):
         """Display CPU utilisation and temperature information.
@@ -431,7 +814,8 @@ class LCDSysInfo(object):
                 pylcdsysinfo.BackgroundColours (defaults to GREEN).
         """
         self.dev.ctrl_transfer(CTRL_WRITE, 21, cpu_util, cpu_temp, chr(util_colour) + chr(temp_colour))
-        time.sleep(self.display_sysinfo_wait_ms / 1000.0)
+        self._remember(('cpu_info',), TextLines.ALL, False, 'display_cpu_info', cpu_util, cpu_temp, util_colour, temp_colour)
+        self._wait_ms(self.display_sysinfo_wait_ms)
 
     def display_ram_gpu_info(self, ram, gpu_temp, ram_colour=TextColours.GREEN, temp_colour=TextColours.GREEN):
         """Display available RAM and GPU temperature information.
@@ -447,7 +831,8 @@ class LCDSysInfo(object):
                 pylcdsysinfo.BackgroundColours (defaults to GREEN).
         """
         self.dev.ctrl_transfer(CTRL_WRITE, 22, ram, gpu_temp, chr(ram_colour) + chr(temp_colour))
-        time.sleep(self.display_sysinfo_wait_ms / 1000.0)
+        self._remember(('ram_gpu_info',), TextLines.ALL, False, 'display_ram_gpu_info', ram, gpu_temp, ram_colour, temp_colour)
+        self._wait_ms(self.display_sysinfo_wait_ms)
 
     def display_network_info(self, recv, sent, recv_colour=TextColours.GREEN, sent_colour=TextColours.GREEN, recv_mb=False, sent_mb=False):
         """Display network utilisation information.
@@ -465,7 +850,8 @@ class LCDSysInfo(object):
             sent_mb (bool): Display transmit rate in kb instead of the default Mb.
         """
         self.dev.ctrl_transfer(CTRL_WRITE, 20, recv, sent, chr(recv_mb) + chr(sent_mb) + chr(recv_colour) + chr(sent_colour))
-        time.sleep(self.display_sysinfo_wait_ms / 1000.0)
+        self._remember(('network_info',), TextLines.ALL, False, 'display_network_info', recv, sent, recv_colour, sent_colour, recv_mb, sent_mb)
+        self._wait_ms(self.display_sysinfo_wait_ms)
 
     def display_fan_info(self, cpufan, chafan, cpufan_colour=TextColours.GREEN, chafan_colour=TextColours.GREEN):
         """Display fan speed information.
@@ -481,7 +867,8 @@ class LCDSysInfo(object):
                 pylcdsysinfo.BackgroundColours (defaults to GREEN).
         """
         self.dev.ctrl_transfer(CTRL_WRITE, 23, cpufan, chafan, chr(cpufan_colour) + chr(chafan_colour))
-        time.sleep(self.display_sysinfo_wait_ms / 1000.0)
+        self._remember(('fan_info',), TextLines.ALL, False, 'display_fan_info', cpufan, chafan, cpufan_colour, chafan_colour)
+        self._wait_ms(self.display_sysinfo_wait_ms)
 
     def send_command_to_flash(self, address, command):
         """Send command to SPI flash memory.
@@ -490,7 +877,7 @@ class LCDSysInfo(object):
             address (int): Address of sector or page to write
             command (int): 0=write enable, 1=write disable, 2=erase sector, 3=program page.
         """
-        self.dev.ctrl_transfer(CTRL_WRITE, 15, address, command)
+        self._flash_transfer(CTRL_WRITE, 15, address, command)
 
     def write_image_to_flash(self, sector, bitmap):
         """Write bitmap image to SPI flash memory.
@@ -498,9 +885,43 @@ class LCDSysInfo(object):
         Args:
             sector (int): Address of starting sector (0-511).
             bitmap (str): Contents of bitmap image, in 16bpp, RGB 5:6:5 format.
+        Returns:
+            The list of page checksums confirmed by the device.
+        """
+        return self._write_raw_to_flash(sector, self._bmp_to_raw(bitmap))
+
+    def _reconnects(self):
+        """Number of times the device has been reopened."""
+        return getattr(self.dev, 'reconnects', 0)
+
+    def _flash_transfer(self, *args):
+        """Perform a control transfer of a flash write, which is not retried after a reconnect."""
+        if isinstance(self.dev, DeviceConnection):
+            return self.dev.ctrl_transfer(*args, retry=False)
+        return self.dev.ctrl_transfer(*args)
+
+    def _check_flash_write(self, reconnects):
+        """Fail a flash write if the device was reopened since it started."""
+        if self._reconnects() != reconnects:
+            raise IOError("LCD Sys Info device was reconnected during flash write")
+
+    def _write_raw_to_flash(self, sector, rawfile):
+        """Write raw format image to SPI flash memory, returning the page checksums."""
+        return [c for c in self._iter_write_raw_to_flash(sector, rawfile) if c is not None]
+
+    def _iter_write_raw_to_flash(self, sector, rawfile):
+        """Write raw format image to SPI flash memory one page at a time.
+
+        Yields None after erasing each sector and the checksum confirmed by
+        the device after each page has been programmed, so that other
+        commands can be sent in between.
+
+        Raises:
+            IOError: A page checksum did not match, or the device was
+                reconnected, losing the write enable and the page buffer.
         """
         address = sector * 16
-        rawfile = self._bmp_to_raw(bitmap)
+        reconnects = self._reconnects()
 
         # write enable flash
         self.send_command_to_flash(0, 5)
@@ -512,7 +933,8 @@ class LCDSysInfo(object):
         for sector in range(0, 1 + int(len(rawfile) / 4096)):
             # erase sector
             self.send_command_to_flash(int(address / 16), 2)
-            time.sleep(self.erase_sector_wait_ms / 1000)
+            self._wait_ms(self.erase_sector_wait_ms)
+            yield None
             for page in range(0, 16):
                 for chunk in range(0, 4):
                     temp_byte = bytearray(b"\x00" * 64)
@@ -521,10 +943,10 @@ class LCDSysInfo(object):
                             temp_byte[k] = rawfile[file_index]
                         file_index += 1
                     # send 64 byte chunk to device's memory buffer, chunk=0,1,2,3
-                    self.dev.ctrl_transfer(CTRL_WRITE, 16, 0, chunk, temp_byte)
+                    self._flash_transfer(CTRL_WRITE, 16, 0, chunk, temp_byte)
 
                 # fetch 2-byte checksum calculated by device
-                b = self.dev.ctrl_transfer(CTRL_READ, 12, 0, 0, 2)
+                b = self._flash_transfer(CTRL_READ, 12, 0, 0, 2)
                 device_checksum = b[0] * 256 + b[1]
 
                 # calculate checksum locally
@@ -536,21 +958,491 @@ class LCDSysInfo(object):
                     raise IOError("Checksum error in page %4x (device=%d local=%d)" % (address, device_checksum, local_checksum))
 
                 # write this 256-byte page to flash memory
+                self._check_flash_write(reconnects)
                 self.send_command_to_flash(address, 3)
-                time.sleep(self.write_page_wait_ms / 1000)
+                self._wait_ms(self.write_page_wait_ms)
+                self._check_flash_write(reconnects)
                 address += 1
+                yield device_checksum
 
         # write disable flash
         self.send_command_to_flash(0, 1)
 
+    def get_serial(self):
+        """Retrieve the serial number of the device as a hex string."""
+        return binascii.hexlify(bytearray(self.dev.ctrl_transfer(CTRL_READ, 12, 0, 5, 8))).decode('ascii')
+
+    def verify_flash(self, images, manifest):
+        """Determine which flash slots do not hold the expected images.
+
+        Costs a single read of the device serial number; a manifest recorded
+        for a different device marks every slot as stale.
+
+        Args:
+            images (dict): Maps starting sectors to bitmap images, in 16bpp,
+                RGB 5:6:5 format.
+            manifest (FlashManifest): Record of the images written to the device.
+        Returns:
+            The sorted list of starting sectors which need to be rewritten.
+        Raises:
+            ValueError: Images overlap each other.
+        """
+        rawfiles = dict((k, self._bmp_to_raw(v)) for k, v in images.items())
+        _check_overlaps(rawfiles)
+        if manifest.serial != self.get_serial():
+            return sorted(images)
+        return manifest.stale_slots(rawfiles)
+
+    def sync_images_to_flash(self, images, manifest):
+        """Write only those images to flash which the manifest does not show as present.
+
+        Args:
+            images (dict): Maps starting sectors to bitmap images, in 16bpp,
+                RGB 5:6:5 format.
+            manifest (FlashManifest): Record of the images written to the device,
+                updated with every image written.
+        Returns:
+            The sorted list of starting sectors which were rewritten.
+        Raises:
+            ValueError: Images overlap each other.
+        """
+        rawfiles = dict((k, self._bmp_to_raw(v)) for k, v in images.items())
+        _check_overlaps(rawfiles)
+        serial = self.get_serial()
+        if manifest.serial != serial:
+            manifest.serial = serial
+            manifest.slots = {}
+        stale = manifest.stale_slots(rawfiles)
+        for sector in stale:
+            # Until the write has completed, the sectors hold neither image
+            manifest.forget(sector, _image_sectors(rawfiles[sector]))
+            manifest.record(sector, rawfiles[sector], self._write_raw_to_flash(sector, rawfiles[sector]))
+        return stale
+
     def get_device_info(self):
         """Retrieve device information."""
         info = { }
-        info['eeprom'] = self.devh.controlMsg(0xc0, 12, 8, 0, 1, self.usb_timeout_ms)
-        info['serial'] = self.devh.controlMsg(0xc0, 12, 8, 0, 5, self.usb_timeout_ms)
-        info['flash_id'] = self.devh.controlMsg(0xc0, 12, 2, 0, 6, self.usb_timeout_ms)
+        info['eeprom'] = self.dev.ctrl_transfer(CTRL_READ, 12, 0, 1, 8)
+        info['serial'] = self.dev.ctrl_transfer(CTRL_READ, 12, 0, 5, 8)
+        info['flash_id'] = self.dev.ctrl_transfer(CTRL_READ, 12, 0, 6, 2)
 
         info['device_valid'] = (info['eeprom'][1] == 102 or info['eeprom'][1] == 103)
         info['picture_frame_mode'] = (info['eeprom'][4] == 136)
         info['8mb_flash'] = (((int(info['eeprom'][6] / 2) & 1) == 0) and ((int(info['eeprom'][6] / 4) & 1) == 0))
         return info
+
+class FrameScheduler(object):
+
+    """Queues LCDSysInfo commands and sends them in frames, ordered by priority
+    and deadline, so that urgent updates are not held up behind slow drawing.
+
+    The device time of each command is estimated with
+    LCDSysInfo.estimate_wait_ms. Urgent commands are always sent; other
+    commands are sent while they fit into the frame budget and deferred to a
+    later frame otherwise. Droppable commands whose deadline has passed are
+    discarded unsent.
+
+    Commands are reordered by priority. When a command is sent ahead of
+    commands queued before it which draw on the same lines, e.g. an urgent
+    alert ahead of a low priority background, it is sent again after each
+    of them, so that the display ends up as if sent in queueing order.
+    """
+
+    frame_budget_ms = 250
+    transfer_ms = 1
+    max_latency_samples = 1000
+
+    def __init__(self, lcd, frame_budget_ms=None):
+        """Create a scheduler for a device.
+
+        Args:
+            lcd (LCDSysInfo): The device to send commands to.
+            frame_budget_ms (int): Estimated device time to spend per frame,
+                excluding urgent commands. Defaults to frame_budget_ms.
+        """
+        self.lcd = lcd
+        if frame_budget_ms is not None:
+            self.frame_budget_ms = frame_budget_ms
+        self._pending = []
+        self._sent_ahead = []
+        self._seq = 0
+
+        self.sent = 0
+        self.resent = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.urgent_latencies_ms = []
+
+    def submit(self, priority, method, *args, **kwargs):
+        """Queue a command.
+
+        Args:
+            priority (int): The priority from pylcdsysinfo.Priority.
+            method (str): Name of the LCDSysInfo method, e.g. "display_text_on_line".
+            args: The arguments to pass to the method.
+            deadline_ms (int): Keyword only. Time from now within which the
+                command should be sent; commands without a deadline are
+                ordered after those with one.
+            key: Keyword only. A queued command with the same key is replaced,
+                e.g. an older text update for the same line.
+            droppable (bool): Keyword only. Whether the command may be
+                discarded once its deadline has passed. Defaults to true for
+                Priority.LOW.
+        """
+        deadline_ms = kwargs.pop('deadline_ms', None)
+        key = kwargs.pop('key', None)
+        droppable = kwargs.pop('droppable', priority == Priority.LOW)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" % ', '.join(sorted(kwargs)))
+
+        now = time.time()
+        deadline = None
+        if deadline_ms is not None:
+            deadline = now + deadline_ms / 1000.0
+        if key is not None:
+            for command in [c for c in self._pending if c['key'] == key]:
+                self._discard(command)
+        self._pending.append({
+            'priority': priority, 'deadline': deadline, 'seq': self._seq, 'submitted': now,
+            'key': key, 'droppable': droppable, 'method': method, 'args': args,
+            'lines': self.lcd.command_lines(method, *args),
+        })
+        self._seq += 1
+
+    def pending(self):
+        """Return the number of queued commands."""
+        return len(self._pending)
+
+    def cost_ms(self, method, *args):
+        """Estimate the device time of a command, including the USB transfer."""
+        return self.transfer_ms + self.lcd.estimate_wait_ms(method, *args)
+
+    def _discard(self, command):
+        """Remove a command from the queue without sending it."""
+        self._pending.remove(command)
+        self._forget_seq(command['seq'])
+
+    def _forget_seq(self, seq):
+        for ahead in self._sent_ahead:
+            ahead['overtook'].discard(seq)
+        self._sent_ahead = [a for a in self._sent_ahead if a['overtook']]
+
+    def _send(self, command):
+        """Send a command, and again any command it has overdrawn.
+
+        Returns:
+            The estimated device time spent, in milliseconds.
+        Raises:
+            IOError: The command could not be sent. It stays queued, to be
+                sent again by the next frame.
+        """
+        getattr(self.lcd, command['method'])(*command['args'])
+        self._pending.remove(command)
+        self.sent += 1
+        if command['priority'] == Priority.URGENT:
+            self.urgent_latencies_ms.append((time.time() - command['submitted']) * 1000)
+            del self.urgent_latencies_ms[:-self.max_latency_samples]
+        spent = self.cost_ms(command['method'], *command['args'])
+
+        # Restore commands which were sent ahead of this one and have just been overdrawn
+        try:
+            for ahead in self._sent_ahead:
+                if command['seq'] in ahead['overtook']:
+                    getattr(self.lcd, ahead['method'])(*ahead['args'])
+                    self.resent += 1
+                    spent += self.cost_ms(ahead['method'], *ahead['args'])
+        finally:
+            self._forget_seq(command['seq'])
+
+        overtook = set(c['seq'] for c in self._pending
+            if c['seq'] < command['seq'] and c['lines'] & command['lines'])
+        if overtook:
+            self._sent_ahead.append(dict(command, overtook=overtook))
+        return spent
+
+    def _sort_pending(self):
+        self._pending.sort(key=lambda c: (c['priority'], c['deadline'] is None, c['deadline'], c['seq']))
+
+    def run_frame(self):
+        """Send the queued commands which fit into one frame.
+
+        Urgent commands are sent first and do not count against the budget.
+        The first other command is always sent, so that a command costing
+        more than the whole budget cannot stall the queue.
+
+        Returns:
+            The estimated device time spent, in milliseconds.
+        """
+        now = time.time()
+        self._sort_pending()
+        spent = budgeted = 0
+        for command in list(self._pending):
+            if command['droppable'] and command['deadline'] is not None and command['deadline'] < now:
+                self._discard(command)
+                self.dropped += 1
+                continue
+            cost = self.cost_ms(command['method'], *command['args'])
+            if command['priority'] != Priority.URGENT:
+                if budgeted and budgeted + cost > self.frame_budget_ms:
+                    # Later commands stay queued behind this one to keep drawing order
+                    self.deferred += len(self._pending)
+                    break
+                budgeted += cost
+            spent += self._send(command)
+        return spent
+
+    def flush(self):
+        """Send all queued commands, ignoring the frame budget."""
+        self._sort_pending()
+        for command in list(self._pending):
+            self._send(command)
+
+    def urgent_latency_ms(self):
+        """Summarise the time from queueing to completion of urgent commands.
+
+        Returns:
+            A dict with the "count", "min", "mean" and "max" latency in
+            milliseconds, or None if no urgent command has been sent.
+        """
+        samples = self.urgent_latencies_ms
+        if not samples:
+            return None
+        return {
+            'count': len(samples),
+            'min': min(samples),
+            'mean': sum(samples) / len(samples),
+            'max': max(samples),
+        }
+
+class SlideshowStreamer(object):
+
+    """Shows a rotating set of full-screen images, which may be larger than
+    the eight large image slots, by uploading the next image into an idle
+    slot while the current one is displayed.
+
+    A USB device handle cannot be shared between threads, so the upload is
+    interleaved with other commands one flash page at a time: every call to
+    step() first runs a frame of the optional FrameScheduler, then switches
+    to the next image if it is due and uploaded, and then spends at most
+    upload_budget_ms erasing sectors and writing pages. Erasing a sector
+    takes LCDSysInfo.erase_sector_wait_ms on its own, which may exceed the
+    budget. Images which the manifest shows to be in a slot already are
+    displayed without uploading.
+    """
+
+    period_s = 10
+    upload_budget_ms = 100
+    idle_sleep_ms = 20
+
+    # Device time of a USB transfer, for estimating the time of the next upload step
+    transfer_ms = 1
+
+    def __init__(self, lcd, images, period_s=None, slots=None, manifest=None, scheduler=None):
+        """Create a slideshow.
+
+        Args:
+            lcd (LCDSysInfo): The device to show the images on.
+            images (list): 320x240 bitmap images, in 16bpp, RGB 5:6:5 format,
+                or callables returning them, which are called each time the
+                image is about to be uploaded.
+            period_s (float): Time to show each image for. Defaults to period_s.
+            slots (list): Starting sectors of the slots to use, at least two
+                from pylcdsysinfo.large_image_indexes, which is the default.
+            manifest (FlashManifest): Record of the images in the slots, which
+                is updated as images are uploaded. It is reset if it was
+                recorded for a different device.
+            scheduler (FrameScheduler): Queue of other commands to send
+                between uploaded pages.
+        Raises:
+            ValueError: No images, fewer than two slots or slots which are
+                not large image slots were given.
+        """
+        if not images:
+            raise ValueError("At least one image is needed")
+        self.lcd = lcd
+        self.images = images
+        if period_s is not None:
+            self.period_s = period_s
+        self.slots = list(slots or large_image_indexes)
+        if len(self.slots) < 2:
+            raise ValueError("At least two slots are needed to upload while displaying")
+        if not set(self.slots) <= set(large_image_indexes):
+            raise ValueError("Slots must be large image slots from large_image_indexes")
+        if manifest is None:
+            manifest = FlashManifest()
+        serial = lcd.get_serial()
+        if manifest.serial != serial:
+            manifest.serial = serial
+            manifest.slots = {}
+        self.manifest = manifest
+        self.scheduler = scheduler
+
+        self.shown_index = None
+        self.shown_slot = None
+        self._last_shown = {}
+        self._next_index = 0
+        self._next_switch = 0
+        self._late = False
+        self._ready = None
+        self._upload = None
+
+        self.switches = 0
+        self.uploads = 0
+        self.failed_uploads = 0
+        self.cache_hits = 0
+        self.late_switches = 0
+        self.upload_bytes = 0
+        self.upload_busy_s = 0
+        self.upload_elapsed_s = 0
+
+    def _render(self, index):
+        image = self.images[index]
+        if callable(image):
+            image = image()
+        return self.lcd._bmp_to_raw(image)
+
+    def _start_upload(self):
+        """Prepare the next image, in a slot which already holds it or by starting an upload."""
+        index = self._next_index
+        self._next_index = (index + 1) % len(self.images)
+        rawfile = self._render(index)
+
+        digest = hashlib.sha1(bytes(rawfile)).hexdigest()
+        for slot in self.slots:
+            if self.manifest.slots.get(slot, {}).get('digest') == digest:
+                self.cache_hits += 1
+                self._ready = (index, slot)
+                return
+
+        # Overwrite the slot which has not been shown for the longest time
+        slot = min([s for s in self.slots if s != self.shown_slot], key=lambda s: self._last_shown.get(s, 0))
+        self.manifest.forget(slot, _image_sectors(rawfile))
+        self._upload = {
+            'index': index, 'slot': slot, 'rawfile': rawfile, 'checksums': [], 'steps': 0,
+            'pages': self.lcd._iter_write_raw_to_flash(slot, rawfile), 'started': time.time(),
+        }
+
+    def _fail_upload(self):
+        """Abandon the current upload, leaving its slot out of the manifest
+        and retrying the image next time."""
+        upload = self._upload
+        self._next_index = upload['index']
+        self._upload = None
+        self.failed_uploads += 1
+        upload['pages'].close()
+        try:
+            # The write enable is lost anyway if the device was reset
+            self.lcd.send_command_to_flash(0, 1)
+        except IOError:
+            pass
+
+    def _next_step_ms(self, upload):
+        """Estimate the time of the next step of an upload."""
+        if len(upload['checksums']) == 16 * _image_sectors(upload['rawfile']):
+            # Only the write disable is left
+            return self.transfer_ms
+        if upload['steps'] % 17 == 0:
+            return self.transfer_ms + self.lcd.erase_sector_wait_ms
+        # Four chunks, the checksum and the page program command
+        return 6 * self.transfer_ms + self.lcd.write_page_wait_ms
+
+    def _upload_pages(self):
+        """Erase sectors and write pages of the current upload for at most
+        upload_budget_ms. A step which would exceed the budget is left for
+        the next call, unless it is the first.
+
+        Raises:
+            IOError: The upload failed; the image is uploaded again from
+                the start on the next step.
+        """
+        upload = self._upload
+        start = time.time()
+        finished = False
+        try:
+            steps = upload['steps']
+            while upload['steps'] == steps or \
+                    (time.time() - start) * 1000 + self._next_step_ms(upload) <= self.upload_budget_ms:
+                try:
+                    checksum = next(upload['pages'])
+                except StopIteration:
+                    finished = True
+                    break
+                upload['steps'] += 1
+                if checksum is not None:
+                    upload['checksums'].append(checksum)
+                    self.upload_bytes += 256
+        except Exception:
+            self._fail_upload()
+            raise
+        finally:
+            self.upload_busy_s += time.time() - start
+
+        if not finished:
+            return
+        if len(upload['checksums']) != 16 * _image_sectors(upload['rawfile']):
+            self._fail_upload()
+            raise IOError("Upload to sector %d ended after %d pages" % (upload['slot'], len(upload['checksums'])))
+        self.manifest.record(upload['slot'], upload['rawfile'], upload['checksums'])
+        self.uploads += 1
+        self.upload_elapsed_s += time.time() - upload['started']
+        self._ready = (upload['index'], upload['slot'])
+        self._upload = None
+
+    def _show(self, now):
+        index, slot = self._ready
+        self._ready = None
+        self.lcd.display_icon(0, slot)
+        self.shown_index = index
+        self.shown_slot = slot
+        self._last_shown[slot] = now
+        self._next_switch = now + self.period_s
+        self._late = False
+        self.switches += 1
+
+    def step(self):
+        """Send queued commands, switch images when due and upload part of the next image."""
+        if self.scheduler is not None:
+            self.scheduler.run_frame()
+
+        if self._ready is None and self._upload is None:
+            self._start_upload()
+
+        now = time.time()
+        if now >= self._next_switch:
+            if self._ready is not None:
+                self._show(now)
+                self._start_upload()
+            elif self.switches and not self._late:
+                self.late_switches += 1
+                self._late = True
+
+        if self._upload is not None:
+            self._upload_pages()
+        else:
+            time.sleep(self.idle_sleep_ms / 1000.0)
+
+    def run(self, duration_s=None):
+        """Run the slideshow, forever or for the specified time."""
+        end = duration_s is not None and time.time() + duration_s or None
+        while end is None or time.time() < end:
+            self.step()
+
+    def stats(self):
+        """Summarise the upload performance.
+
+        Returns:
+            A dict with the number of "switches", "uploads", "failed_uploads",
+            "cache_hits" and "late_switches", where the next image was not
+            uploaded in time, the "upload_bytes_per_s" while uploading and
+            the "achievable_period_s", the mean time from starting an upload
+            until the image could be shown.
+        """
+        return {
+            'switches': self.switches,
+            'uploads': self.uploads,
+            'failed_uploads': self.failed_uploads,
+            'cache_hits': self.cache_hits,
+            'late_switches': self.late_switches,
+            'upload_bytes_per_s': self.upload_busy_s and self.upload_bytes / self.upload_busy_s or 0,
+            'achievable_period_s': self.uploads and self.upload_elapsed_s / self.uploads or 0,
+        }
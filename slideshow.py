@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import print_function
+import sys, os, subprocess
+from pylcdsysinfo import LCDSysInfo, SlideshowStreamer
+
+def usage():
+    print("Usage: %s <seconds per image> <imagefile>..." % (sys.argv[0]), file=sys.stderr)
+    sys.exit(1)
+
+if len(sys.argv) < 3:
+    usage()
+
+try:
+    period = float(sys.argv[1])
+    if period <= 0:
+        raise ValueError("Out of bounds")
+except ValueError:
+    usage()
+
+infiles = sys.argv[2:]
+
+for infile in infiles:
+    if not os.path.isfile(infile):
+        print("No such file '%s'" % (infile), file=sys.stderr)
+        sys.exit(1)
+
+def converter(infile):
+    """Convert the file each time it is uploaded, so that updated reports are shown."""
+    # Hack - redirect stderr to /dev/null to prevent noisy ffmpeg output
+    return lambda: subprocess.Popen("ffmpeg -f image2 -i %s -vcodec bmp -pix_fmt rgb565 -s 320x240 -f image2 - 2>/dev/null" % (infile),
+        shell=True, stdout=subprocess.PIPE).stdout.read()
+
+d = LCDSysInfo()
+s = SlideshowStreamer(d, [converter(infile) for infile in infiles], period)
+try:
+    while True:
+        try:
+            s.run()
+        except IOError as e:
+            # The failed image is uploaded again on the next step
+            print("Upload failed: %s" % (e), file=sys.stderr)
+except KeyboardInterrupt:
+    stats = s.stats()
+    print("""Images shown: %(switches)d
+Uploads: %(uploads)d (%(cache_hits)d already in a slot, %(failed_uploads)d failed)
+Late switches: %(late_switches)d
+Upload throughput: %(upload_bytes_per_s).0f bytes/s
+Achievable period: %(achievable_period_s).1f s""" % stats)